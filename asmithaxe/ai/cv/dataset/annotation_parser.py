@@ -4,14 +4,23 @@ Classes related to parsing annotation files for image datasets.
 Copyright (c) 2021, Aaron Smith. All rights reserved.
 """
 
+from collections import defaultdict
 import csv
-import xml.etree.ElementTree as xml_parser
 from PIL import Image
 import logging
+import sys
+
+# Prefer the libxml2-backed lxml parser when it is installed, falling back to the standard library otherwise.
+try:
+    from lxml import etree as xml_parser
+    _LXML_AVAILABLE = True
+except ImportError:
+    import xml.etree.ElementTree as xml_parser
+    _LXML_AVAILABLE = False
 
 from .annotations import ImageAnnotation, ObjectAnnotation
 from .pipeline import PipelineStateListener
-from .utils import find_image_filename
+from .utils import find_image_filename, read_image_size
 
 
 ########################################################################################################################
@@ -22,6 +31,8 @@ class AnnotationListener:
     for processing.
     """
 
+    __slots__ = ()
+
     def on_annotation_available(self, image_annotation, object_annotations):
         """
         Invoked when a complete annotation is available for processing.
@@ -72,30 +83,58 @@ class CvatAnnotationFileParser(AnnotationFileParser):
 
     def on_pipeline_start(self):
         super().on_pipeline_start()
-        xml_tree = xml_parser.parse(self.annotation_filename)
-        root_node = xml_tree.getroot()
+
         image_count = 0
-        for image_node in root_node.findall('./image'):
+        for image_node in self._iter_image_nodes():
             image_count += 1
-            image_filename = find_image_filename(self.image_dict, image_node.attrib['name'])
-            image_width = int(image_node.attrib['width'])
-            image_height = int(image_node.attrib['height'])
+            image_filename = find_image_filename(self.image_dict, image_node.get('name'))
+            image_width = int(image_node.get('width'))
+            image_height = int(image_node.get('height'))
             image_annotation = ImageAnnotation(image_filename, image_width, image_height)
 
             object_annotations = []
-            for box_node in image_node.findall('./box'):
-                label = box_node.attrib['label']
+            for box_node in image_node.iterfind('box'):
+                # Intern the label, so that every annotation of the same class shares a single string.
+                label = sys.intern(box_node.get('label'))
                 object_annotations.append(ObjectAnnotation(label,
-                                                           float(box_node.attrib['xtl']),
-                                                           float(box_node.attrib['xbr']),
-                                                           float(box_node.attrib['ytl']),
-                                                           float(box_node.attrib['ybr'])))
+                                                           float(box_node.get('xtl')),
+                                                           float(box_node.get('xbr')),
+                                                           float(box_node.get('ytl')),
+                                                           float(box_node.get('ybr'))))
 
             for listener in self.annotation_listeners:
                 listener.on_annotation_available(image_annotation, object_annotations)
 
         self.logger.debug(f'{image_count} images parsed.')
 
+    def _iter_image_nodes(self):
+        """
+        Stream the 'image' nodes from the annotation file rather than building the whole document in memory. Each node
+        is yielded once complete, and is released (along with any siblings already processed) once the caller resumes
+        iteration.
+
+        :return: generator of complete 'image' nodes.
+        """
+        if _LXML_AVAILABLE:
+            # Let libxml2 filter the 'image' tags rather than testing every node in Python, and disable the features
+            # that CVAT files do not use: DTD loading, entity resolution and whitespace/comment nodes. The size limits
+            # are lifted as CVAT exports of large datasets can exceed them.
+            for _, image_node in xml_parser.iterparse(self.annotation_filename, events=('end',), tag='image',
+                                                      load_dtd=False, no_network=True, resolve_entities=False,
+                                                      remove_blank_text=True, remove_comments=True, huge_tree=True):
+                yield image_node
+                image_node.clear()
+                while image_node.getprevious() is not None:
+                    del image_node.getparent()[0]
+        else:
+            root_node = None
+            for event, image_node in xml_parser.iterparse(self.annotation_filename, events=('start', 'end')):
+                if root_node is None:
+                    root_node = image_node
+                elif event == 'end' and image_node.tag == 'image':
+                    yield image_node
+                    root_node.clear()
+
 
 ########################################################################################################################
 
@@ -121,74 +160,67 @@ class CatlinSeaviewSurveyCsvAnnotationFileParser(AnnotationFileParser):
     def on_pipeline_start(self):
         super().on_pipeline_start()
 
-        # Build a map of annotations to each image.
-        image_to_annotations_dict = {}
-        csv_reader = csv.reader(open(self.annotation_filename), delimiter=',')
-        for row in csv_reader:
-            file_id = row[0]
-            short_filename = row[0] + '.jpg'
-            dataset = row[7]
-
-            # Check if the image is available for processing, and the dataset filter matches (if set).
-            if short_filename in self.image_dict and \
-                    (self.dataset_filter is None or self.dataset_filter == dataset):
-
-                y = int(row[1])
-                x = int(row[2])
-                label_name = row[3]
-                label = row[4]
-                func_group = row[5]
-
-                if not short_filename in image_to_annotations_dict:
-                    image_to_annotations_dict[short_filename] = []
-                annotations = image_to_annotations_dict[short_filename]
-                annotations.append({
-                    'file_id': file_id,
-                    'short_filename': short_filename,
-                    'x': x,
-                    'y': y,
-                    'label_name': label_name,
-                    'label': label,
-                    'func_group': func_group,
-                    'dataset': dataset
-                })
+        # Build a map of annotations to each image. Only the fields used to build the ObjectAnnotations are retained,
+        # as an (x, y, label) tuple per annotation. The labels are interned, so that every annotation of the same class
+        # shares a single string rather than one per row.
+        image_to_annotations_dict = defaultdict(list)
+        image_dict = self.image_dict
+        dataset_filter = self.dataset_filter
+
+        # The csv module performs its own newline handling, so the file is opened with newline=''. A larger read buffer
+        # reduces the number of reads on large annotation files.
+        with open(self.annotation_filename, newline='', buffering=1 << 20) as annotation_file:
+            csv_reader = csv.reader(annotation_file, delimiter=',')
+            for row in csv_reader:
+
+                # Check the dataset filter matches (if set) before building the filename, then check if the image is
+                # available for processing.
+                if dataset_filter is not None and dataset_filter != row[7]:
+                    continue
+                short_filename = row[0] + '.jpg'
+                if short_filename in image_dict:
+                    image_to_annotations_dict[short_filename].append((int(row[2]), int(row[1]), sys.intern(row[4])))
+
+        # A patch fits entirely within the image when its centre lies strictly inside the image shrunk by half a patch on
+        # each side. Resolve the loop invariants once, leaving only the per-image limits to be calculated.
+        half_patch_width = self.image_patch_width // 2
+        half_patch_height = self.image_patch_height // 2
+        min_x = half_patch_width
+        min_y = half_patch_height
+        annotation_listeners = self.annotation_listeners
 
         # Process each image/annotation grouping.
         image_count = 0
-        for short_filename in image_to_annotations_dict:
-            annotations = image_to_annotations_dict[short_filename]
+        for short_filename, annotations in image_to_annotations_dict.items():
             image_count += 1
 
-            # Populate the image annotation.
-            image_filename = self.image_dict[short_filename]
-            image = Image.open(image_filename)
-            image_width, image_height = image.size
+            # Populate the image annotation, reading the image size from the file header where possible rather than
+            # having PIL parse the file.
+            image_filename = image_dict[short_filename]
+            image_size = read_image_size(image_filename)
+            if image_size is None:
+                with Image.open(image_filename) as image:
+                    image_size = image.size
+            image_width, image_height = image_size
             image_annotation = ImageAnnotation(image_filename=image_filename,
                                                image_width=image_width,
                                                image_height=image_height)
+            max_x = image_width - half_patch_width
+            max_y = image_height - half_patch_height
+
+            # Cache the object annotations that fit entirely within the image.
             object_annotations = []
-            for annotation in annotations:
-
-                # Capture the object annotations.
-                xmin = annotation['x'] - self.image_patch_width // 2
-                xmax = annotation['x'] + self.image_patch_width // 2
-                ymin = annotation['y'] - self.image_patch_height // 2
-                ymax = annotation['y'] + self.image_patch_height // 2
-
-                # Cache the object annotations if they fit entirely within the image.
-                if xmin > 0 \
-                        and xmax < image_annotation.image_width \
-                        and ymin > 0 \
-                        and ymax < image_annotation.image_height:
-                    object_annotations.append(ObjectAnnotation(label=annotation['label'],
-                                                               xmin=xmin,
-                                                               xmax=xmax,
-                                                               ymin=ymin,
-                                                               ymax=ymax))
+            for x, y, label in annotations:
+                if min_x < x < max_x and min_y < y < max_y:
+                    object_annotations.append(ObjectAnnotation(label=label,
+                                                               xmin=x - half_patch_width,
+                                                               xmax=x + half_patch_width,
+                                                               ymin=y - half_patch_height,
+                                                               ymax=y + half_patch_height))
 
             # Trigger registered annotation listeners.
             if len(object_annotations) > 0:
-                for listener in self.annotation_listeners:
+                for listener in annotation_listeners:
                     listener.on_annotation_available(image_annotation, object_annotations)
 
         self.logger.debug(f'{image_count} images parsed.')
@@ -10,18 +10,26 @@ class ImageAnnotation:
     Value object representing the annotation of a single image.
     """
 
-    def __init__(self, image_filename, image_width, image_height):
+    __slots__ = ('image_filename', 'image_format', 'image_width', 'image_height', 'encoded_image')
+
+    def __init__(self, image_filename, image_width, image_height, encoded_image=None):
         self.image_filename = image_filename
-        self.image_format = 'png' if image_filename.endswith('png') else 'jpg'
+        self.image_format = 'png' if image_filename[-3:].lower() == 'png' else 'jpg'
         self.image_width = image_width
         self.image_height = image_height
 
+        # The original contents of the image file, if retained by the ImageLoader.
+        self.encoded_image = encoded_image
+
 
 class ObjectAnnotation:
     """
-    Value object representing the annotation of a single object within an annotated image.
+    Value object representing the annotation of a single object within an annotated image. Instances are created for
+    every object in a dataset, so __slots__ is used to avoid a per-instance __dict__.
     """
 
+    __slots__ = ('label', 'xmin', 'xmax', 'ymin', 'ymax')
+
     def __init__(self, label, xmin, xmax, ymin, ymax):
         self.label = label
         self.xmin = xmin
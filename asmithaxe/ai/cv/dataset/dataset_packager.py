@@ -4,10 +4,13 @@ Classes related to packaging image datasets.
 Copyright (c) 2021, Aaron Smith. All rights reserved.
 """
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import io
+import numpy as np
 import os
 import tensorflow as tf
-from object_detection.utils import dataset_util
+import threading
 import logging
 
 from .image_processor import AnnotatedImageListener
@@ -36,7 +39,8 @@ class TensorFlowRecordDatasetPackager(DatasetPackager):
     Specialisation of the DatasetPackager for packaging an annotated image in a TensorFlowRecord file.
     """
 
-    def __init__(self, dataset_filename, label_collector=None, normalise_bounding_boxes=True):
+    def __init__(self, dataset_filename, label_collector=None, normalise_bounding_boxes=True, max_workers=0,
+                 jpeg_quality=75, compression=None):
         """
         Capture the properties on instantiation.
 
@@ -45,80 +49,187 @@ class TensorFlowRecordDatasetPackager(DatasetPackager):
         file.
         :param normalise_bounding_boxes: flag that determines if the bounding box values are to be normalised with
         height/width on not.
+        :param max_workers: the number of threads used to encode images and serialise examples in the background. The
+        examples are still written in the order the images are received. When zero, each image is packaged on the
+        calling thread. When non-zero, an image that has to be encoded is loaded and copied on the calling thread, and
+        the worker encodes the copy, so other listeners remain free to use or modify the image.
+        :param jpeg_quality: the quality (1-95) used when an image has to be JPEG encoded for the dataset. Defaults to
+        PIL's default. It only applies to the images encoded by this packager, and does not affect how other listeners
+        save the image.
+        :param compression: optional compression applied to the dataset file, either 'GZIP' or 'ZLIB'. Compression is
+        applied as records are written, reducing the size of the file written to disk. Readers of the dataset must
+        specify the same compression type.
         """
         super().__init__()
 
         # Cache the name of the dataset file to create and ensure it's path exists.
         self.dataset_filename = dataset_filename
         path = os.path.split(self.dataset_filename)[0]
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if path:
+            os.makedirs(path, exist_ok=True)
 
         # Cache the reference to the label collector.
         self.label_collector = label_collector
 
         # Cache other properties.
         self.normalise_bounding_boxes = normalise_bounding_boxes
+        self.jpeg_quality = jpeg_quality
 
-        # Instantiate a writer for generating the dataset file.
-        self.dataset_writer = tf.io.TFRecordWriter(self.dataset_filename)
+        # Instantiate a writer for generating the dataset file, compressing the records if required.
+        self.compression = compression
+        if self.compression is None:
+            self.dataset_writer = tf.io.TFRecordWriter(self.dataset_filename)
+        else:
+            self.dataset_writer = tf.io.TFRecordWriter(
+                self.dataset_filename, options=tf.io.TFRecordOptions(compression_type=self.compression))
+
+        # Instantiate the pool of threads for serialising examples in the background, if required, along with the queue
+        # of examples still to be written. Image encoding releases the GIL, so threads are sufficient.
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self._pending_examples = collections.deque()
+
+        # Each thread that encodes images reuses its own buffer, so that no extra buffer is allocated per image.
+        self._encoding_buffers = threading.local()
 
         # Keep track of unique class ids for the labelmap file and also for referencing the class in the data.
         self.unique_class_ids = {}
 
+        # Cache the UTF-8 encoding of each label, as the same labels are repeated across many images.
+        self._encoded_labels = {}
+
         # Keep track of images processed for information purposes.
         self.image_count = 0
 
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
         self.image_count += 1
-        xmins = []
-        xmaxs = []
-        ymins = []
-        ymaxs = []
+
+        # Gather the bounding boxes into a single array, one row per object, and transform them to fractions within the
+        # image size with a single vectorised divide, if required. Double precision is kept until the values are stored,
+        # so each fraction is rounded to a float only once, when the example is serialised.
+        boxes = np.array([(object_annotation.xmin, object_annotation.xmax, object_annotation.ymin, object_annotation.ymax)
+                          for object_annotation in object_annotations], dtype=np.float64).reshape(-1, 4)
+        if self.normalise_bounding_boxes:
+            image_width = image_annotation.image_width
+            image_height = image_annotation.image_height
+            boxes /= np.array((image_width, image_width, image_height, image_height), dtype=np.float64)
+        xmins, xmaxs, ymins, ymaxs = boxes.T.tolist()
+
+        # Obtain the encoded text and unique id for each label.
+        encoded_labels = self._encoded_labels
+        find_label_id = self.label_collector.find
         classes_text = []
         classes_id = []
         for object_annotation in object_annotations:
             label = object_annotation.label
+            encoded_label = encoded_labels.get(label)
+            if encoded_label is None:
+                encoded_label = encoded_labels[label] = label.encode('utf8')
+            classes_text.append(encoded_label)
+            classes_id.append(find_label_id(label))
+
+        # Store the original contents of the image file if they were retained and are already JPEG encoded, otherwise
+        # the image is encoded when the example is serialised.
+        if image_annotation.encoded_image is not None and image_annotation.image_format == 'jpg':
+            encoded_image = image_annotation.encoded_image
+        else:
+            encoded_image = None
+
+        if self._executor is None:
+            self.dataset_writer.write(self._serialise_example(image, encoded_image, image_annotation, xmins, xmaxs,
+                                                              ymins, ymaxs, classes_text, classes_id))
+        else:
+            # PIL loads images lazily and neither loading nor saving is thread-safe, as saving temporarily sets the
+            # encoder settings on the image. Complete the load here rather than on a worker, and give the worker its own
+            # copy to encode, so that it never shares an image with other listeners.
+            if encoded_image is None:
+                image.load()
+                image = image.copy()
+
+            # Serialise the example in the background. Examples at the front of the queue are written as soon as they
+            # are complete, waiting on the oldest example only once twice as many examples as workers are in flight, so
+            # that each worker has another image queued while the oldest example is waited on.
+            pending_examples = self._pending_examples
+            pending_examples.append(self._executor.submit(self._serialise_example, image, encoded_image,
+                                                          image_annotation, xmins, xmaxs, ymins, ymaxs, classes_text,
+                                                          classes_id))
+            while pending_examples and (pending_examples[0].done() or len(pending_examples) > 2 * self.max_workers):
+                self.dataset_writer.write(pending_examples.popleft().result())
+
+    def _serialise_example(self, image, encoded_image, image_annotation, xmins, xmaxs, ymins, ymaxs, classes_text,
+                           classes_id):
+        """
+        Build and serialise the tf.train.Example for an image, encoding the image first if required. This may be invoked
+        on a background thread.
+
+        :param image: the image to encode if encoded_image is not provided.
+        :param encoded_image: the JPEG encoded image, or None to encode the image.
+        :param image_annotation: the ImageAnnotation for the image.
+        :param xmins: the (optionally normalised) left edge of each bounding box.
+        :param xmaxs: the (optionally normalised) right edge of each bounding box.
+        :param ymins: the (optionally normalised) top edge of each bounding box.
+        :param ymaxs: the (optionally normalised) bottom edge of each bounding box.
+        :param classes_text: the UTF-8 encoded label of each bounding box.
+        :param classes_id: the unique id of the label of each bounding box.
+        :return: the serialised example.
+        """
+        if encoded_image is None:
+            encoded_image = self._encode_image(image)
+        encoded_filename = image_annotation.image_filename.encode('utf8')
+
+        # Populate the features in place through the generated protobuf API, rather than building an intermediate
+        # tf.train.Feature for each one.
+        tf_example = tf.train.Example()
+        feature = tf_example.features.feature
+        feature['image/height'].int64_list.value.append(image_annotation.image_height)
+        feature['image/width'].int64_list.value.append(image_annotation.image_width)
+        feature['image/filename'].bytes_list.value.append(encoded_filename)
+        feature['image/source_id'].bytes_list.value.append(encoded_filename)
+        feature['image/encoded'].bytes_list.value.append(encoded_image)
+        feature['image/format'].bytes_list.value.append(image_annotation.image_format.encode())
+        feature['image/object/bbox/xmin'].float_list.value.extend(xmins)
+        feature['image/object/bbox/xmax'].float_list.value.extend(xmaxs)
+        feature['image/object/bbox/ymin'].float_list.value.extend(ymins)
+        feature['image/object/bbox/ymax'].float_list.value.extend(ymaxs)
+        feature['image/object/class/text'].bytes_list.value.extend(classes_text)
+        feature['image/object/class/label'].int64_list.value.extend(classes_id)
+        return tf_example.SerializeToString()
+
+    def _encode_image(self, image):
+        """
+        JPEG encode the image using the calling thread's encoding buffer. The buffer is overwritten rather than truncated,
+        so that its allocation is retained between images, and only the bytes written for this image are returned.
 
-            # Obtain the unique id for the label.
-            label_id = self.label_collector.find(label)
-
-            # Transform the bounding box locations to fractions within the image size.
-            xmins.append(
-                object_annotation.xmin / image_annotation.image_width if self.normalise_bounding_boxes else object_annotation.xmin)
-            xmaxs.append(
-                object_annotation.xmax / image_annotation.image_width if self.normalise_bounding_boxes else object_annotation.xmax)
-            ymins.append(
-                object_annotation.ymin / image_annotation.image_height if self.normalise_bounding_boxes else object_annotation.ymin)
-            ymaxs.append(
-                object_annotation.ymax / image_annotation.image_height if self.normalise_bounding_boxes else object_annotation.ymax)
-            classes_text.append(label.encode('utf8'))
-            classes_id.append(label_id)
-
-        # encoded_image = image.getData()
-        imageBuf = io.BytesIO()
-        image.save(imageBuf, format="JPEG")
-        encoded_image = imageBuf.getvalue()
-        tf_example = tf.train.Example(features=tf.train.Features(feature={
-            'image/height': dataset_util.int64_feature(image_annotation.image_height),
-            'image/width': dataset_util.int64_feature(image_annotation.image_width),
-            'image/filename': dataset_util.bytes_feature(image_annotation.image_filename.encode('utf8')),
-            'image/source_id': dataset_util.bytes_feature(image_annotation.image_filename.encode('utf8')),
-            'image/encoded': dataset_util.bytes_feature(encoded_image),
-            'image/format': dataset_util.bytes_feature(image_annotation.image_format.encode()),
-            'image/object/bbox/xmin': dataset_util.float_list_feature(xmins),
-            'image/object/bbox/xmax': dataset_util.float_list_feature(xmaxs),
-            'image/object/bbox/ymin': dataset_util.float_list_feature(ymins),
-            'image/object/bbox/ymax': dataset_util.float_list_feature(ymaxs),
-            'image/object/class/text': dataset_util.bytes_list_feature(classes_text),
-            'image/object/class/label': dataset_util.int64_list_feature(classes_id),
-        }))
-        self.dataset_writer.write(tf_example.SerializeToString())
+        :param image: the image to encode.
+        :return: the JPEG encoded image.
+        """
+        encoding_buffer = getattr(self._encoding_buffers, 'buffer', None)
+        if encoding_buffer is None:
+            encoding_buffer = self._encoding_buffers.buffer = io.BytesIO()
+        encoding_buffer.seek(0)
+        image.save(encoding_buffer, format='JPEG', quality=self.jpeg_quality)
+        encoded_size = encoding_buffer.tell()
+        with encoding_buffer.getbuffer() as encoded_view:
+            return encoded_view[:encoded_size].tobytes()
 
     def on_pipeline_stop(self):
         self.logger.debug(f'{self.image_count} images packaged.')
-        # Close the dataset file.
-        self.dataset_writer.close()
+
+        # Write any examples still being serialised in the background. The pool and dataset file are released even if
+        # an example failed, cancelling any examples not yet started. The futures are cancelled individually, as
+        # shutdown(cancel_futures=True) is not available before Python 3.9.
+        try:
+            while self._pending_examples:
+                self.dataset_writer.write(self._pending_examples.popleft().result())
+        finally:
+            for pending_example in self._pending_examples:
+                pending_example.cancel()
+            self._pending_examples.clear()
+            if self._executor is not None:
+                self._executor.shutdown()
+
+            # Close the dataset file.
+            self.dataset_writer.close()
 
 
 ########################################################################################################################
@@ -136,12 +247,11 @@ class StoreByFullFilenameDatasetPackager(DatasetPackager):
         """
         super().__init__()
         self.output_path = output_path
-        if not os.path.exists(self.output_path):
-            os.makedirs(self.output_path)
+        os.makedirs(self.output_path, exist_ok=True)
         self.image_count = 0
 
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
-        image.copy().save(os.path.join(self.output_path, image_annotation.image_filename))
+        image.save(os.path.join(self.output_path, image_annotation.image_filename))
         self.image_count += 1
 
     def on_pipeline_stop(self):
@@ -163,8 +273,7 @@ class StoreByShortFilenameDatasetPackager(DatasetPackager):
         """
         super().__init__()
         self.output_path = output_path
-        if not os.path.exists(self.output_path):
-            os.makedirs(self.output_path)
+        os.makedirs(self.output_path, exist_ok=True)
         self.image_count = 0
 
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
@@ -193,13 +302,18 @@ class StoreByLabelDatasetPackager(DatasetPackager):
         self.output_path = output_path
         self.image_count = 0
 
+        # Map each label to its sub-directory, which is created the first time the label is seen.
+        self._label_output_paths = {}
+
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
 
         if len(object_annotations) > 0:
-            object_annotation = object_annotations[0]
-            _output_path = os.path.join(self.output_path, object_annotation.class_id)
-            if not os.path.exists(_output_path):
-                os.makedirs(_output_path)
+            label = object_annotations[0].label
+            _output_path = self._label_output_paths.get(label)
+            if _output_path is None:
+                _output_path = os.path.join(self.output_path, label)
+                os.makedirs(_output_path, exist_ok=True)
+                self._label_output_paths[label] = _output_path
             image.save(os.path.join(_output_path, os.path.basename(image_annotation.image_filename)))
             self.image_count += 1
 
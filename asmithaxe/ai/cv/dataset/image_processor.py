@@ -5,6 +5,7 @@ Copyright (c) 2021, Aaron Smith. All rights reserved.
 """
 
 from PIL import Image
+import io
 import logging
 import os
 from object_detection.utils import visualization_utils as viz_utils
@@ -33,8 +34,23 @@ class ImageLoader(AnnotationListener):
     processing.
     """
 
-    def __init__(self, annotated_image_listeners):
+    def __init__(self, annotated_image_listeners, retain_encoded_image=False, draft_size=None):
+        """
+        Capture the properties on instantiation.
+
+        :param annotated_image_listeners: array of AnnotatedImageListener implementations to notify when the image has
+        been loaded.
+        :param retain_encoded_image: flag that determines if the original contents of the image file are retained on the
+        ImageAnnotation, allowing a DatasetPackager to store them without re-encoding the image. Only enable this when
+        the listeners do not modify the image before it is packaged.
+        :param draft_size: optional (width, height) that the listeners require the image to be no smaller than. When
+        set, JPEG images are decoded directly at the smallest reduced scale (1/2, 1/4 or 1/8) that still satisfies this
+        size, which is considerably faster than a full decode. The ImageAnnotation and ObjectAnnotations are scaled to
+        match the decoded image.
+        """
         self.annotated_image_listeners = annotated_image_listeners
+        self.retain_encoded_image = retain_encoded_image
+        self.draft_size = draft_size
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def on_annotation_available(self, image_annotation, object_annotations):
@@ -45,10 +61,48 @@ class ImageLoader(AnnotationListener):
         Image, ImageAnnotation, array of ObjectAnnotation.
         """
         if len(object_annotations) > 0:
-            image = Image.open(image_annotation.image_filename)
+            if self.retain_encoded_image:
+                # Read the file once, and decode the image from the retained contents.
+                with open(image_annotation.image_filename, 'rb') as file:
+                    image_annotation.encoded_image = file.read()
+                image = Image.open(io.BytesIO(image_annotation.encoded_image))
+            else:
+                image = Image.open(image_annotation.image_filename)
+            if self.draft_size is not None:
+                image, image_annotation, object_annotations = self._draft(image, image_annotation, object_annotations)
             for listener in self.annotated_image_listeners:
                 listener.on_annotated_image_available(image, image_annotation, object_annotations)
 
+    def _draft(self, image, image_annotation, object_annotations):
+        """
+        Configure the (not yet loaded) image to be decoded at a reduced scale, if the format supports it, and scale the
+        annotations to match.
+
+        :param image: the image, as returned by Image.open.
+        :param image_annotation: the ImageAnnotation for the image.
+        :param object_annotations: array of ObjectAnnotations for the image.
+        :return: the image, ImageAnnotation and array of ObjectAnnotations to pass to the listeners.
+        """
+        original_width, original_height = image.size
+        image.draft(image.mode, self.draft_size)
+        image_width, image_height = image.size
+        if image_width == original_width and image_height == original_height:
+            return image, image_annotation, object_annotations
+
+        # The retained file contents no longer match the image size, so they are not passed on.
+        scale_x = image_width / original_width
+        scale_y = image_height / original_height
+        image_annotation = ImageAnnotation(image_filename=image_annotation.image_filename,
+                                           image_width=image_width,
+                                           image_height=image_height)
+        object_annotations = [ObjectAnnotation(label=object_annotation.label,
+                                               xmin=object_annotation.xmin * scale_x,
+                                               xmax=object_annotation.xmax * scale_x,
+                                               ymin=object_annotation.ymin * scale_y,
+                                               ymax=object_annotation.ymax * scale_y)
+                              for object_annotation in object_annotations]
+        return image, image_annotation, object_annotations
+
 
 ########################################################################################################################
 
@@ -74,55 +128,60 @@ class CroppingImageProcessor(ImageProcessor):
     """
 
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
-        split_filename = os.path.splitext(image_annotation.image_filename)
-        filename_prefix = split_filename[0]
-        filename_suffix = split_filename[1]
-        crop_count = 0
-        for object_annotation in object_annotations:
+        filename_prefix, filename_suffix = os.path.splitext(image_annotation.image_filename)
+        image_width = image_annotation.image_width
+        image_height = image_annotation.image_height
+        annotated_image_listeners = self.annotated_image_listeners
+        for crop_count, object_annotation in enumerate(object_annotations):
+            xmin = object_annotation.xmin
+            xmax = object_annotation.xmax
+            ymin = object_annotation.ymin
+            ymax = object_annotation.ymax
 
             # Crop the image.
-            cropped_image = image.crop((object_annotation.xmin, object_annotation.ymin, object_annotation.xmax,
-                                        object_annotation.ymax))
+            cropped_image = image.crop((xmin, ymin, xmax, ymax))
 
             # Build the new ImageAnnotation and ObjectAnnotation for the cropped image.
-            new_image_annotation = ImageAnnotation(
-                image_filename=filename_prefix + '_' + str(crop_count) + filename_suffix,
-                image_width=image_annotation.image_width,
-                image_height=image_annotation.image_height
-            )
-            new_object_annotation = ObjectAnnotation(class_id=object_annotation.class_id,
+            new_image_annotation = ImageAnnotation(image_filename=f'{filename_prefix}_{crop_count}{filename_suffix}',
+                                                   image_width=image_width,
+                                                   image_height=image_height)
+            new_object_annotation = ObjectAnnotation(label=object_annotation.label,
                                                      xmin=0,
-                                                     xmax=object_annotation.xmax - object_annotation.xmin,
+                                                     xmax=xmax - xmin,
                                                      ymin=0,
-                                                     ymax=object_annotation.ymax - object_annotation.ymin)
+                                                     ymax=ymax - ymin)
 
             # Invoke the next ImageProcessor(s).
-            for listener in self.annotated_image_listeners:
+            for listener in annotated_image_listeners:
                 listener.on_annotated_image_available(cropped_image, new_image_annotation, [new_object_annotation])
 
-            # Increment the counter.
-            crop_count += 1
-
 
 ########################################################################################################################
 
 class AnnotationRenderingImageProcessor(ImageProcessor):
     """
-    Specialisation of the ImageProcessor that renders the ObjectAnnotations on the image.
+    Specialisation of the ImageProcessor that renders the ObjectAnnotations on a copy of the image, leaving the original
+    image unchanged for any other listeners that receive it.
     """
 
     def on_annotated_image_available(self, image, image_annotation, object_annotations):
+        rendered_image = image.copy()
         for object_annotation in object_annotations:
-            viz_utils.draw_bounding_box_on_image(image,
+            viz_utils.draw_bounding_box_on_image(rendered_image,
                                                  object_annotation.ymin,
                                                  object_annotation.xmin,
                                                  object_annotation.ymax,
                                                  object_annotation.xmax,
                                                  color='white',
                                                  thickness=1,
-                                                 display_str_list=(object_annotation.class_id,),
+                                                 display_str_list=(object_annotation.label,),
                                                  use_normalized_coordinates=False)
 
+        # The rendered image no longer matches the original contents of the image file, so they are not passed on.
+        rendered_image_annotation = ImageAnnotation(image_filename=image_annotation.image_filename,
+                                                    image_width=image_annotation.image_width,
+                                                    image_height=image_annotation.image_height)
+
         # Invoke the next ImageProcessor(s).
         for listener in self.annotated_image_listeners:
-            listener.on_annotated_image_available(image, image_annotation, object_annotations)
+            listener.on_annotated_image_available(rendered_image, rendered_image_annotation, object_annotations)
@@ -6,6 +6,7 @@ Copyright (c) 2021, Aaron Smith. All rights reserved.
 
 import logging
 import os
+import sys
 
 from .annotation_parser import AnnotationListener
 from .pipeline import PipelineStateListener
@@ -16,11 +17,14 @@ class LabelCollector(AnnotationListener, PipelineStateListener):
     this class provide additional services, such as persistence services.
     """
 
+    __slots__ = ('logger', 'unique_labels', '_next_id')
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
-        # Keep track of the unique labels.
+        # Keep track of the unique labels, and the id to assign to the next new label.
         self.unique_labels = {}
+        self._next_id = 1
 
     def on_annotation_available(self, image_annotation, object_annotations):
         """
@@ -29,11 +33,31 @@ class LabelCollector(AnnotationListener, PipelineStateListener):
         :param label: the label to cache.
         """
 
+        unique_labels = self.unique_labels
         for object_annotation in object_annotations:
             label = object_annotation.label
-            if label not in self.unique_labels:
-                self.unique_labels[label] = len(self.unique_labels) + 1
-                self.logger.debug(f'Adding "{label}"')
+
+            # Ids are assigned in increasing order, so the label is new only if it was given the next id.
+            next_id = self._next_id
+            if unique_labels.setdefault(label, next_id) == next_id:
+                self._next_id = next_id + 1
+                self.logger.debug('Adding "%s"', label)
+
+    def bulk_register(self, labels):
+        """
+        Add any new labels from a known set of labels, such as those gathered by pre-scanning a dataset, without logging
+        each label as it is added.
+
+        :param labels: iterable of labels to cache. Labels already held by the collector are ignored.
+        """
+        unique_labels = self.unique_labels
+        next_id = self._next_id
+        for label in labels:
+            # Intern the label, as it may not have been produced by one of the annotation parsers.
+            if unique_labels.setdefault(sys.intern(label), next_id) == next_id:
+                next_id += 1
+        self.logger.debug('Added %d labels.', next_id - self._next_id)
+        self._next_id = next_id
 
     def find(self, label):
         """
@@ -42,7 +66,7 @@ class LabelCollector(AnnotationListener, PipelineStateListener):
         :param label: the search string
         :return: the position of the specified label within the collection.
         """
-        return self.unique_labels[label] if label in self.unique_labels else None
+        return self.unique_labels.get(label)
 
     def get_num(self):
         """
@@ -60,6 +84,8 @@ class LabelMapLabelCollector(LabelCollector):
     Specialisation of the LabelCollector that persists the list of unique labels as a LabelMap file.
     """
 
+    __slots__ = ('filename',)
+
     def __init__(self, filename):
         super().__init__()
 
@@ -68,13 +94,12 @@ class LabelMapLabelCollector(LabelCollector):
 
         # Ensure the location exists.
         path = os.path.split(self.filename)[0]
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if path:
+            os.makedirs(path, exist_ok=True)
 
     def on_pipeline_stop(self):
-        file = open(self.filename, 'w')
-        for label in self.unique_labels:
-            file.write('item {\n')
-            file.write('id: ' + str(self.unique_labels[label]) + '\n')
-            file.write('name: \'' + label + '\'\n')
-            file.write('}\n')
+        # Stream the items of the LabelMap file through a large write buffer, rather than building the whole content in
+        # memory first.
+        with open(self.filename, 'w', buffering=1 << 20) as file:
+            file.writelines(f"item {{\nid: {label_id}\nname: '{label}'\n}}\n"
+                            for label, label_id in self.unique_labels.items())
@@ -37,6 +37,8 @@ class Pipeline:
 
 class PipelineStateListener:
 
+    __slots__ = ()
+
     def on_pipeline_start(self):
         """
         Invoked by the Pipeline when it receives the 'start' instruction.
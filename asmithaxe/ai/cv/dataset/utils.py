@@ -1,29 +1,72 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import io
 import os
-import re
+import struct
+
+# The filename extensions (in lower case) of the image files searched for.
+_IMG_EXTS = ('.jpg', '.jpeg', '.png')
+
+# The JPEG start-of-frame markers, whose segments hold the image dimensions.
+_JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
 
 
 def build_image_dict(path):
     """
-    Recursive function for building a dictionary of image files (jpg and png), mapping filename -> full path, from the
-    root path specified. The function is recursively invoked for each sub-directory.
+    Function for building a dictionary of image files (jpg and png), mapping filename -> full path, from the root path
+    specified, including all sub-directories.
 
     Note: the function assumes that each filename is unique.
 
-    :param path: the path from which to search for image files. Any directories found in the path will result in this
-    function being recursively invoked.
+    :param path: the path from which to search for image files, including all sub-directories.
+    :return: dictionary of image files where the key is the unique filename, and the value is the full path name.
+    """
+    return dict(iter_image_entries(path))
+
+
+def build_image_dict_parallel(path, max_workers=8):
+    """
+    Equivalent of build_image_dict that scans the directories on a pool of threads, so that the latency of reading many
+    directories is overlapped rather than incurred one directory at a time. Each directory is scanned as a separate task,
+    with the sub-directories found being submitted as further tasks until no directories remain.
+
+    Note: the function assumes that each filename is unique.
+
+    :param path: the path from which to search for image files, including all sub-directories.
+    :param max_workers: the number of threads used to scan directories.
     :return: dictionary of image files where the key is the unique filename, and the value is the full path name.
     """
     image_dict = {}
-    for filename in os.listdir(path):
-        full_path = os.path.join(path, filename)
-        if (os.path.isdir(full_path)):
-            image_dict.update(build_image_dict(full_path))
-        else:
-            if filename.endswith(('.jpg', '.png', '.jpeg')):
-                image_dict[filename] = full_path
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending_scans = {executor.submit(_scan_image_directory, path)}
+        while pending_scans:
+            completed_scans, pending_scans = wait(pending_scans, return_when=FIRST_COMPLETED)
+            for completed_scan in completed_scans:
+                images, sub_directories = completed_scan.result()
+                image_dict.update(images)
+                pending_scans.update(executor.submit(_scan_image_directory, sub_directory)
+                                     for sub_directory in sub_directories)
     return image_dict
 
 
+def _scan_image_directory(path):
+    """
+    Helper function to scan a single directory for image files (jpg and png) and sub-directories.
+
+    :param path: the directory to scan.
+    :return: tuple of the list of (filename, full path name) pairs of the image files found, and the list of full path
+    names of the sub-directories found.
+    """
+    images = []
+    sub_directories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                sub_directories.append(entry.path)
+            elif _is_image(entry.name):
+                images.append((entry.name, entry.path))
+    return images, sub_directories
+
+
 def find_image_filename(input_image_dict, filename):
     """
     Helper function to retrieve the full filename of the specified image using the provided dictionary.
@@ -32,25 +75,141 @@ def find_image_filename(input_image_dict, filename):
     :param short_filename: the unique short filename of the image to use to look up the full filename in the dictionary.
     :return: the full image filename.
     """
-    short_filename = filename if "/" not in filename else re.split("([^/]+$)", filename)[1]
+    short_filename = filename.rpartition('/')[2]
     return input_image_dict[short_filename]
 
 
 def build_image_list(path):
     """
-    Recursive function for building a list of image files (jpg and png) for the path specified. The function is
-    recursively invoked for each sub-directory.
+    Function for building a flat list of image files (jpg and png) found in the path specified, or any of its
+    sub-directories.
 
-    :param path: the path from which to search for image files. Any directories found in the path will result in this
-    function being recursively invoked.
+    :param path: the path from which to search for image files, including all sub-directories.
     :return: list of full path names of image files found.
     """
-    image_list = []
-    for filename in os.listdir(path):
-        full_path = os.path.join(path, filename)
-        if (os.path.isdir(full_path)):
-            image_list.append(build_image_list(full_path))
-        else:
-            if filename.endswith(('.jpg', '.png', '.jpeg')):
-                image_list.append(full_path)
-    return image_list
+    return list(iter_image_paths(path))
+
+
+def iter_image_entries(path):
+    """
+    Generator for lazily finding the image files (jpg and png) in the path specified, or any of its sub-directories
+    (following symbolic links), so that callers iterating over the images once need not hold them all in memory. The
+    directories are traversed depth-first with an explicit stack rather than recursion.
+
+    :param path: the path from which to search for image files, including all sub-directories.
+    :return: generator of (filename, full path name) pairs for each image file found.
+    """
+    pending_directories = [path]
+    while pending_directories:
+        sub_directories = []
+        with os.scandir(pending_directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    sub_directories.append(entry.path)
+                elif _is_image(entry.name):
+                    yield entry.name, entry.path
+
+        # Push the sub-directories in reverse, so that they are visited in the order in which they were found.
+        pending_directories.extend(reversed(sub_directories))
+
+
+def iter_image_paths(path):
+    """
+    Generator for lazily finding the full path names of the image files (jpg and png) in the path specified, or any of
+    its sub-directories.
+
+    :param path: the path from which to search for image files, including all sub-directories.
+    :return: generator of the full path name of each image file found.
+    """
+    for _, image_path in iter_image_entries(path):
+        yield image_path
+
+
+def iter_image_dir_entries(path):
+    """
+    Generator for finding the image files (jpg and png) in the path specified, or any of its sub-directories
+    (following symbolic links), yielding an open file descriptor of the directory holding each image. Images can then
+    be opened relative to that descriptor, e.g. os.open(filename, os.O_RDONLY, dir_fd=dir_fd), so the directory path is
+    resolved once per directory rather than once per image.
+
+    Note: as with os.fwalk, on which this is built, each descriptor is closed once iteration moves on to the next
+    directory, so it must be used (or duplicated with os.dup) before the generator is resumed. Only available on
+    platforms that support os.fwalk.
+
+    :param path: the path from which to search for image files, including all sub-directories.
+    :return: generator of (directory file descriptor, filename) pairs for each image file found.
+    """
+    for _, _, filenames, dir_fd in os.fwalk(path, follow_symlinks=True):
+        for filename in filenames:
+            if _is_image(filename):
+                yield dir_fd, filename
+
+
+def _is_image(filename):
+    """
+    Helper function to check if a filename has an image extension, ignoring case. Only the tail of the filename, long
+    enough to hold any of the extensions, is lowered.
+
+    :param filename: the filename to check.
+    :return: True if the filename has an image extension, False otherwise.
+    """
+    return filename[-5:].lower().endswith(_IMG_EXTS)
+
+
+def read_image_size(filename):
+    """
+    Helper function to read the size of a JPEG or PNG image from the file header, without decoding the image.
+
+    :param filename: the full filename of the image.
+    :return: the (width, height) of the image, or None if the size could not be read from the header.
+    """
+    with open(filename, 'rb') as file:
+        header = file.read(24)
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+            # The IHDR chunk is always first, and starts with the width and height.
+            return struct.unpack('>II', header[16:24])
+        if header[:2] == b'\xff\xd8':
+            file.seek(2)
+            return _read_jpeg_size(file)
+    return None
+
+
+def _read_jpeg_size(file):
+    """
+    Helper function to read the size of a JPEG image by skipping from segment to segment until a start-of-frame segment
+    is found.
+
+    :param file: the JPEG file, positioned after the start-of-image marker.
+    :return: the (width, height) of the image, or None if no usable start-of-frame segment was found.
+    """
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+
+        # Skip any fill bytes preceding the marker type.
+        marker_type = marker[1]
+        while marker_type == 0xFF:
+            fill = file.read(1)
+            if not fill:
+                return None
+            marker_type = fill[0]
+
+        if marker_type in _JPEG_SOF_MARKERS:
+            # Segment length (2 bytes), sample precision (1 byte), height (2 bytes) and width (2 bytes).
+            segment = file.read(7)
+            if len(segment) < 7:
+                return None
+            height, width = struct.unpack('>HH', segment[3:7])
+            return (width, height) if width > 0 and height > 0 else None
+        if marker_type == 0x01 or 0xD0 <= marker_type <= 0xD7:
+            # Stand-alone markers have no segment.
+            continue
+        if marker_type in (0xD9, 0xDA):
+            # End of image, or start of scan, before any start-of-frame segment.
+            return None
+
+        length = file.read(2)
+        if len(length) < 2:
+            return None
+        file.seek(struct.unpack('>H', length)[0] - 2, io.SEEK_CUR)